@@ -5,7 +5,6 @@ from src.patroller.chinese_postman import ChinesePostmanProblem
 sys.path.append('../../')
 
 from src.test_info.get_test_json_graph import get_test_nodes_to_visit
-from src.utilities.move_to_point import get_distance_angle_between_points
 
 
 class RoutePlanner:
@@ -21,19 +20,17 @@ class RoutePlanner:
     def find_current_node(self, current_location):
         """We assume that we're basically sitting on top of a node -- all we need to do is find which one"""
         closest_node = None
-        closest_node_distance = None
+        closest_node_distance_sq = None
 
-        temp_current_loc = [current_location["x"], current_location["y"]]
+        current_x, current_y = current_location["x"], current_location["y"]
 
         for _id in self.node_dictionary:
-            temp_target_point = [self.node_dictionary[_id]["x"], self.node_dictionary[_id]["y"]]
-            length, angle_to_rotate, target_angle = get_distance_angle_between_points(
-                temp_target_point,
-                temp_current_loc,
-                0
-            )
-            if closest_node is None or length < closest_node_distance:
-                closest_node_distance = length
+            # squared distances order the same as distances, so skip the sqrt
+            dx = self.node_dictionary[_id]["x"] - current_x
+            dy = self.node_dictionary[_id]["y"] - current_y
+            distance_sq = dx * dx + dy * dy
+            if closest_node is None or distance_sq < closest_node_distance_sq:
+                closest_node_distance_sq = distance_sq
                 closest_node = _id
 
         return closest_node
@@ -4,6 +4,8 @@
 # Date: 11/9/2021
 
 
+import array
+
 import rospy
 import numpy as np
 import json
@@ -30,47 +32,60 @@ if __name__ == '__main__':
     with open("./src/test_info/grid_msg_info.txt", 'r') as fp:
         info = json.loads(fp.read())
 
+    # pull the constants out of the nested info dict once
+    frame_id = info["header"]["frame_id"]
+    resolution = float(info["info"]["resolution"])
+    width = int(info["info"]["width"])
+    height = int(info["info"]["height"])
+    position = info["info"]["origin"]["position"]
+    orientation = info["info"]["origin"]["orientation"]
+
     # do several reshapes and blur to allow blurring in two dimensions
-    print(int(info["info"]["height"]), int(info["info"]["width"]))
-    blurred_data = np.reshape(
-        100 * ndimage.binary_dilation(
-            np.reshape(data, (int(info["info"]["height"]), int(info["info"]["width"]))), 
-            iterations=10
-        ),
-        info["info"]["height"] * info["info"]["width"]
-    )
+    # a square dilation is separable, so two 1-d max passes (21x1 then 1x21)
+    # cover the same window as the ten iterated 3x3 passes did
+    print(height, width)
+    grid = data.reshape(height, width) # a view, no copy
+    gd = ndimage.grey_dilation((grid != 0).astype(np.uint8), size=(21, 1))
+    gd = ndimage.grey_dilation(gd, size=(1, 21))
+    # write the occupancy values straight into int8 instead of letting
+    # 100 * gd promote to a wide integer temporary
+    blurred_data = np.where(gd, np.int8(100), np.int8(0)).ravel()
 
     static_map_pub = rospy.Publisher(PUBLISH_TOPIC, OccupancyGrid, queue_size=1)
     blurred_map_pub = rospy.Publisher(BLUR_TOPIC, OccupancyGrid, queue_size=1)
 
-
-while not rospy.is_shutdown():
-        # Static map
-        msg = OccupancyGrid()
-
-        msg.header.frame_id = info["header"]["frame_id"]
-
-        msg.info.origin = Pose()
-        msg.data = data
-        msg.info.resolution = float(info["info"]["resolution"])
-        msg.info.width = int(info["info"]["width"])
-        msg.info.height = int(info["info"]["height"])
-        x, y, z = info["info"]["origin"]["position"]["x"], info["info"]["origin"]["position"]["y"], info["info"]["origin"]["position"]["z"]
-        msg.info.origin.position.x = x
-        msg.info.origin.position.y = y
-        msg.info.origin.position.z = z
-        rot_x, rot_y, rot_z, rot_w = info["info"]["origin"]["orientation"]["x"], info["info"]["origin"]["orientation"]["y"], info["info"]["origin"]["orientation"]["z"], info["info"]["origin"]["orientation"]["w"]
-        msg.info.origin.orientation.x = rot_x
-        msg.info.origin.orientation.y = rot_y
-        msg.info.origin.orientation.z = rot_z
-        msg.info.origin.orientation.w = rot_w
+    # The maps never change, so build both messages once and only publish in
+    # the loop
+    msg = OccupancyGrid()
+
+    msg.header.frame_id = frame_id
+
+    msg.info.origin = Pose()
+    # pack the cells once into a bytes-like buffer so rospy serializes the
+    # whole array with a single memcpy instead of per-cell struct.pack calls
+    msg.data = array.array('b', data.astype(np.int8).tobytes())
+    msg.info.resolution = resolution
+    msg.info.width = width
+    msg.info.height = height
+    msg.info.origin.position.x = position["x"]
+    msg.info.origin.position.y = position["y"]
+    msg.info.origin.position.z = position["z"]
+    msg.info.origin.orientation.x = orientation["x"]
+    msg.info.origin.orientation.y = orientation["y"]
+    msg.info.origin.orientation.z = orientation["z"]
+    msg.info.origin.orientation.w = orientation["w"]
+
+    blurred_msg = OccupancyGrid()
+    blurred_msg.header.frame_id = msg.header.frame_id
+    blurred_msg.info = msg.info
+    blurred_msg.data = array.array('b', blurred_data.tobytes())
+
+    while not rospy.is_shutdown():
+        msg.header.stamp = rospy.Time.now()
+        blurred_msg.header.stamp = msg.header.stamp
 
         static_map_pub.publish(msg)
-
-
-        # Blur the same map with a gaussian filter the map and publish
-        msg.data = blurred_data
-        blurred_map_pub.publish(msg)
+        blurred_map_pub.publish(blurred_msg)
 
         rate.sleep()
 
@@ -2,14 +2,21 @@
 
 # A ROS service that generates a topological map of a published occupancy grid
 # Author: Isaac Feldman, COSC 81 Fall 2021
+import hashlib
 import json
-from collections import deque
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numba
 import numpy as np
 
 # Image processing Imports
-from scipy import ndimage # for EDT
-from skimage import morphology # for binary_dilation, skeletonization
-from skimage.feature import corner_harris, corner_peaks
+import edt # multithreaded Felzenszwalb-Huttenlocher EDT
+from scipy import ndimage # for convolve
+from scipy.signal import fftconvolve # for fast dilation with a large kernel
+from scipy.spatial import cKDTree # for fast neighbor lookups
+from skimage import morphology # for skeletonization
 
 # ROS Imports
 import rospy
@@ -18,8 +25,65 @@ from std_srvs.srv import Trigger, TriggerResponse   # http://docs.ros.org/en/mel
 
 DEFAULT_MAP_TOPIC    = "static_map"
 DEFAULT_SERVICE      = "graph"
-CORNER_SENS          = 0.025 # Tune these values for the map!
-THIN                 = 0.5
+THIN                 = 0.5 # Tune this value for the map!
+
+# 8-connectivity offsets, materialized once for the skeleton walker
+NEIGHBOR_DY = np.array((-1, -1, -1, 0, 0, 1, 1, 1), dtype=np.int64)
+NEIGHBOR_DX = np.array((-1, 0, 1, -1, 1, -1, 0, 1), dtype=np.int64)
+
+
+@numba.njit(cache=True, nogil=True)
+def _walk_skeleton(skel, corner_map, sy, sx, home_id, visited, stamp, stack, out_ids):
+    """ Depth first walk of the skeleton from each pixel around a corner.
+
+    Each of the eight branches stops at the first other corner it reaches and
+    writes that corner's id into out_ids. visited holds a per-branch stamp so
+    it never needs clearing between walks; stack is a preallocated scratch
+    buffer shared across calls.
+
+    :param skel: the skeleton as a contiguous int8 array
+    :param corner_map: int32 array mapping skeleton pixels to corner ids (-1 elsewhere)
+    :param sy, sx: the pixel coordinates of the home corner
+    :param home_id: the id of the home corner
+    :returns the number of ids written to out_ids and the updated stamp
+    """
+    height, width = skel.shape
+    found = 0
+    for k in range(8):
+        y0 = sy + NEIGHBOR_DY[k]
+        x0 = sx + NEIGHBOR_DX[k]
+        if y0 < 0 or y0 >= height or x0 < 0 or x0 >= width:
+            continue
+        stamp += 1
+        stack[0, 0] = y0
+        stack[0, 1] = x0
+        visited[y0, x0] = stamp
+        top = 1
+        done = False
+        while top > 0 and not done:
+            top -= 1
+            cy = stack[top, 0]
+            cx = stack[top, 1]
+            for m in range(8):
+                ny = cy + NEIGHBOR_DY[m]
+                nx = cx + NEIGHBOR_DX[m]
+                if ny < 0 or ny >= height or nx < 0 or nx >= width:
+                    continue
+                if visited[ny, nx] == stamp:
+                    continue
+                visited[ny, nx] = stamp
+                other = corner_map[ny, nx]
+                if other >= 0 and other != home_id:
+                    out_ids[found] = other
+                    found += 1
+                    done = True
+                    break
+                if skel[ny, nx] > 0:
+                    stack[top, 0] = ny
+                    stack[top, 1] = nx
+                    top += 1
+    return found, stamp
+
 
 class Server():
     def __init__(self):
@@ -28,6 +92,10 @@ class Server():
         self._map_offset = None
         self._skel = None
         self._count = 0
+        self._map_hash = None
+        self._cached_hash = None
+        self._cached_json = None
+        self._map_ready = threading.Event()
 
         self._graph_service = rospy.Service(DEFAULT_SERVICE, Trigger, self._graph_callback)
         self._map_sub = rospy.Subscriber(DEFAULT_MAP_TOPIC, OccupancyGrid, self._map_callback, queue_size=1)
@@ -39,243 +107,195 @@ class Server():
         self._map_resolution = float(msg.info.resolution)
         self._map_offset = (msg.info.origin.position.x, msg.info.origin.position.y)
 
-        grid = np.reshape(msg.data, (height, width))
+        # keep the grid in int8 (the wire type) -- reshaping the raw tuple
+        # would build a wide array element by element
+        if isinstance(msg.data, bytes):
+            grid = np.frombuffer(msg.data, dtype=np.int8).reshape(height, width)
+        else:
+            grid = np.asarray(msg.data, dtype=np.int8).reshape(height, width)
+        self._map_hash = hashlib.blake2b(grid.tobytes(), digest_size=16).digest()
         self._map = grid
+        self._map_ready.set()
 
     def _graph_callback(self, req):
         """
         Process the map into a graph by request
         """
         resp = TriggerResponse()
-        response_graph = json.dumps(self.compute_graph())
+        # the static map rarely changes, so reuse the last graph when it hasn't
+        if self._cached_json is None or self._map_hash != self._cached_hash:
+            self._cached_json = json.dumps(self.compute_graph())
+            self._cached_hash = self._map_hash
         resp.success = True
-        resp.message = response_graph
-        print(response_graph)
+        resp.message = self._cached_json
+        print(self._cached_json)
         return resp
 
     def compute_graph(self):
         """ Compute a topological graph from the provided map """
-        while self._map is None:
-            pass # block until we have a map
+        self._map_ready.wait() # block until we have a map
 
         print("Computing the graph...")
         # Compute the edt on a dilated map so the robot will never hit the wall
-        dilated = morphology.binary_dilation(self._map, morphology.square(40))
-        dmap = np.bitwise_not(dilated)
-        dmap[dmap<0] = 100
-        d, f = ndimage.distance_transform_edt(dmap, return_indices=True)
+        # A 40x40 structuring element is large enough that dilation is much
+        # cheaper as an FFT convolution thresholded back to binary
+        kernel = np.ones((40, 40), dtype=np.float32)
+        occupied = (self._map != 0).astype(np.float32)
+        dilated = fftconvolve(occupied, kernel, mode='same') > 0.5
+        # the EDT is memory bound, so hand it the smallest buffer it can use
+        free = np.ascontiguousarray(dilated == 0, dtype=np.uint8)
+        d = edt.edt(free, parallel=os.cpu_count())
         mean = np.mean(d)
-        # Now create a thinned skeleton and extract the keypoints from it
+        # Now create a thinned skeleton and extract the keypoints from it.
+        # On a one-pixel-wide skeleton the keypoints are just the pixels with
+        # a neighbor count other than 2: endpoints (1) and junctions (3+)
         self._skel = morphology.skeletonize(d > mean*THIN)
-        corners = corner_peaks(corner_harris(self._skel, k=CORNER_SENS), min_distance=1)
-        
-
-        coords = []
-        for c in corners:
-          coords.append((c[1], c[0])) #x, y
-        print("Detected", len(coords), "key points")
-
-        # First do a few traversal to find the neighboring feature nodes
-        graph = self._add_nodes(coords)
-        for i in range(10): # do this a few times
-          self._add_neighbors(graph, coords)
-
-        ids, rev_ids = {}, {} # two dictionaries to help wrangle the nodes
-        self._set_ids(graph, ids, rev_ids)
-
-        self._make_graph_symmetrical(graph) # make sure every node's neighbors point to the node
-
-        pruned_graph = self._prune_graph(graph, 100)
-        #print(pruned_graph)
-        #print("\n\n")
-        nodes_of_interest = []
-        for node in pruned_graph:
-            nodes_of_interest.append((node["x"], node["y"]))
-
-        self._add_neighbors(pruned_graph, nodes_of_interest) # this adds all the neighbors back because there's some bug in the pruning that removes all of them
-
-        self._set_ids(pruned_graph, ids, rev_ids)    # convert the raw coordinates added into ids
-        self._make_graph_symmetrical(pruned_graph) # make sure every node's neighbors point to the node
-        #print(len(pruned_graph))
-        #print("\n\n")
-        
-        # remove all the neighbors that aren't actually in the graph 
-        for node in pruned_graph:
-            to_remove = []
-            for neighbor in node["neighbors"]:
-                if not self._id_in_graph(neighbor, pruned_graph):
-                    to_remove.append(neighbor)
-            for item in to_remove:
-                node["neighbors"].remove(item)
-
-        for g in pruned_graph: # convert the neighbor sets to lists for JSON
-            x, y = g["x"], g["y"]
-        
-            nx = x*self._map_resolution + self._map_offset[0]
-            ny = y*self._map_resolution + self._map_offset[1]
-            g["neighbors"] = list(g["neighbors"])
-            g["x"] = nx 
-            g["y"] = ny 
+        skel_u8 = self._skel.view(np.uint8) # reinterpret the bools, no copy
+        degree = ndimage.convolve(skel_u8, np.ones((3, 3), np.uint8), mode='constant') - skel_u8
+        corners = np.argwhere(self._skel & ((degree == 1) | (degree >= 3)))
+
+
+        # The nodes live in parallel arrays (coordinates and ids) plus a list
+        # of neighbor-id sets; dicts only get built at JSON time
+        xs = corners[:, 1].astype(np.int32)
+        ys = corners[:, 0].astype(np.int32)
+        print("Detected", len(xs), "key points")
+
+        # Traverse the skeleton to find the neighboring feature nodes
+        ids, neighbors = self._add_nodes(len(xs))
+        self._add_neighbors(xs, ys, ids, neighbors)
+
+        self._make_graph_symmetrical(ids, neighbors) # make sure every node's neighbors point to the node
+
+        keep, rep = self._prune_graph(xs, ys, ids, 100)
+        # remap edges that pointed at pruned nodes onto their surviving
+        # representative, so the skeleton never has to be traversed again
+        pruned_neighbors = []
+        for i in np.flatnonzero(keep):
+            node_id = int(ids[i])
+            pruned_neighbors.append({rep.get(n, n) for n in neighbors[i]
+                                     if rep.get(n, n) != node_id})
+        xs, ys, ids = xs[keep], ys[keep], ids[keep]
+        neighbors = pruned_neighbors
+
+        self._make_graph_symmetrical(ids, neighbors) # make sure every node's neighbors point to the node
+
+        # convert the pixel coordinates to world coordinates in two vector ops
+        xs_world = xs * self._map_resolution + self._map_offset[0]
+        ys_world = ys * self._map_resolution + self._map_offset[1]
+
+        # build the JSON-friendly dicts, dropping neighbors that aren't
+        # actually in the graph
+        valid_ids = set(ids.tolist())
+        pruned_graph = []
+        for i in range(len(ids)):
+            pruned_graph.append({"x": float(xs_world[i]), "y": float(ys_world[i]),
+                                 "id": int(ids[i]),
+                                 "neighbors": [n for n in neighbors[i] if n in valid_ids]})
         print(self._map_resolution, self._map_offset)
-        return pruned_graph 
-                
-
-    def _id_in_graph(self, id, graph):
-        """
-        Search for an id in a graph
-        """
-        for n in graph:
-            if n["id"] == id:
-                return True
-        return False
+        return pruned_graph
 
 
-    def _set_ids(self, graph, ids, rev_ids):
-        """
-        When the nodes are added, their neighbor lists have no ids,
-        this function adds them
-        """
-        for node in graph:
-          ids[(node["x"], node["y"])] = node["id"]
-        for node in graph:
-          rev_ids[node["id"]] = node
-
-        for node in graph:
-          new_neighbors = set() 
-          for n in node["neighbors"]:
-              if type(n) is tuple:
-                new_neighbors.add(ids[n])
-          node["neighbors"] = new_neighbors
-
-    def _make_graph_symmetrical(self, graph):
+    def _make_graph_symmetrical(self, ids, neighbors):
         """
         Make sure every node's neighbors points at the node
-        """
-
-        for i in range(len(graph)):
-          for j in range(len(graph)):
-            if i == j:
-              continue
-            node, other = graph[i], graph[j]
-            if node["id"] in other["neighbors"] and other["id"] not in node["neighbors"]:
-              node["neighbors"].add(other["id"])
 
-    def _dist(self, x1, y1, x2, y2):
-        """
-        Euclidean Distance Helper
+        :param ids: int array of node ids
+        :param neighbors: list of neighbor-id sets, parallel to ids
         """
-        return np.linalg.norm(np.array((x1, y1)) - np.array((x2, y2)))
-        #return ((x2-x1)**2 + (y2-y1)**2)**(1/2)
+        index_of = {int(node_id): i for i, node_id in enumerate(ids)}
+        for i, node_id in enumerate(ids):
+          for neighbor in list(neighbors[i]):
+            if neighbor in index_of: # stale ids from pruned nodes get filtered later
+              neighbors[index_of[neighbor]].add(int(node_id))
 
-    def _prune_graph(self, graph, thresh=100):
+    def _prune_graph(self, xs, ys, ids, thresh=100):
       """
-      Removes nodes in the graph that are too close to their neighbors
+      Marks nodes that are too close to their neighbors for removal
 
-      :param graph: the graph to prune
+      :param xs, ys: int arrays of node pixel coordinates
+      :param ids: int array of node ids
       :param thresh: the distance threshold to determine when to prune
-      :returns the pruned graph
+      :returns a boolean keep mask over the nodes and a dict mapping each
+               dropped node's id to the id of its surviving representative
       """
-
-      to_remove  = set()
-      for node in graph:
-        if node["id"] in to_remove:
-          continue
-        for other in graph:
-          if node != other:
-            if self._dist(other["x"], other["y"], node["x"], node["y"]) < thresh : 
-              to_remove.add(other['id'])
-      # We use a removal list so the neighbors set doesn't change during iteration
-      #for node in to_remove:
-      #  for neighbor in graph[node]["neighbors"]:
-      #    graph[node]["neighbors"].remove(neighbor)
-      # Compile these into a new graph...
-      new_graph = []
-      for i in range(len(graph)):
-        if i not in to_remove:
-          new_graph.append(graph[i])
-
-      return new_graph
-
-
-    def _add_nodes(self, coords):
+      keep = np.ones(len(xs), dtype=bool)
+      rep = {}
+      if len(xs) < 2:
+        return keep, rep
+
+      # Let a KD-tree find every close pair at once instead of scanning all N^2
+      pts = np.column_stack((xs, ys)).astype(np.float64)
+      tree = cKDTree(pts)
+      pairs = tree.query_pairs(thresh, output_type='ndarray')
+      # For each close pair keep the lower-indexed node and drop the other
+      keep[np.unique(pairs[:, 1])] = False
+
+      # Remember who absorbed each dropped node: its lowest-indexed partner,
+      # with chains followed until they end at a survivor
+      parent = {}
+      for i, j in pairs:
+        i, j = int(i), int(j)
+        if j not in parent or i < parent[j]:
+          parent[j] = i
+      for j in parent:
+        i = parent[j]
+        while not keep[i]:
+          i = parent[i]
+        rep[int(ids[j])] = int(ids[i])
+
+      return keep, rep
+
+    def _add_nodes(self, n):
       """
-      Compiles the nodes in coords into a list of dictionaries that hold their info
+      Allocates ids and empty neighbor sets for n new nodes
       """
-      graph = []
-      for c in coords:
-        x, y = c
-        g = {"x": x, "y": y, "id": self._count, "neighbors": set()}
-        graph.append(g)
-        self._count += 1
-      return graph
-
-    def _add_neighbors(self, graph, coords):
-        """ Use a simple depth first traversal to find the immediate neighbors of each node
-
-        :param graph: a list of dictionary graph elements
-        :param coords: a list of coordinates of interest; the features in the graph image
+      ids = np.arange(self._count, self._count + n, dtype=np.int32)
+      self._count += n
+      neighbors = [set() for _ in range(n)]
+      return ids, neighbors
+
+    def _add_neighbors(self, xs, ys, ids, neighbors):
+        """ Walk the skeleton to find the immediate neighbors of each node
+
+        Every nonzero pixel of the skeleton is walkable, but the pixels that
+        matter are the ones holding a graph node. Each node gets linked to the
+        first other node reached along each skeleton branch leaving it, so
+        nodes connect to their nearest neighbors on the skeleton.
+
+        The walks only read the skeleton and each node belongs to exactly one
+        chunk, so the chunks run in parallel threads (the jitted walker
+        releases the GIL).
+
+        :param xs, ys: int arrays of node pixel coordinates
+        :param ids: int array of node ids
+        :param neighbors: list of neighbor-id sets, parallel to ids
         """
-        for node in graph:
-            x, y = node["x"], node["y"]
-            for neighbor in self.eight_neighbors((x, y), self._skel):
-              u, v = neighbor
-              self._traverse(neighbor, node, coords)
+        if len(ids) == 0:
+            return
+
+        skel = self._skel.view(np.int8) # reinterpret the bools, no copy
+        corner_map = -np.ones(skel.shape, dtype=np.int32)
+        corner_map[ys, xs] = ids
+        stack_size = np.count_nonzero(skel) + 1
+
+        def walk_chunk(indices):
+            # every thread gets its own scratch buffers
+            visited = np.zeros(skel.shape, dtype=np.int64)
+            stack = np.empty((stack_size, 2), dtype=np.int32)
+            out_ids = np.empty(8, dtype=np.int32)
+            stamp = 0
+            for i in indices:
+                found, stamp = _walk_skeleton(skel, corner_map, ys[i], xs[i],
+                                              ids[i], visited, stamp, stack, out_ids)
+                for k in range(found):
+                    neighbors[i].add(int(out_ids[k]))
+
+        workers = min(os.cpu_count() or 1, len(ids))
+        chunks = [range(i, len(ids), workers) for i in range(workers)]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(walk_chunk, chunks))
 
-    def _traverse(self, start, home, coords):
-        """
-        Do a depth first traversal of the skeleton.
-        This approach treats every nonzero pixel of the skeleton as a node to expand.
-        However, the nodes that are important are the ones marked in the coords array.
-        The function traverses the skeleton until it hits a node in the coords array, then
-        it links the node in coords to the last node from coords it saw. 
-        This way the nodes get connected to their neighbors nearest to them on the skeleton.
-
-        :param start: the first node in the traversal
-        :param home: the origin node for which we are connecting the neighbors of
-        :param coords: the list of nodes that are of interest (list of x,y tuples)
-        """
-        seen = set()
-        q = deque()
-        q.append(start)
-        while len(q) > 0:
-          curr = q.pop()
-          for neighbor in self.eight_neighbors(curr, self._skel):
-            if neighbor not in seen and neighbor is not None:
-              x, y = neighbor
-              seen.add(neighbor)
-              if self._skel[(y, x)] > 0:
-                q.append(neighbor)
-              if neighbor in coords and neighbor != (home["x"], home["y"]):
-                home["neighbors"].add(neighbor)
-                return
-
-
-    def eight_neighbors(self, c, map):
-      """ Return the indices of the neighboring pixels 
-
-      :param c: an x,y tuple for the point of interest
-      :param map: a numpy array representing the image
-      :returns a list of x,y tuples
-      """
-      x, y = c
-      width, height = map.shape
-      N = (x, max(0, y-1))
-      NE = (min(width-1, x+1), max(0, y-1))
-      E = (min(width-1, x+1), y)
-      SE = (min(width-1, x+1),min(height-1, y+1))
-      S = (x, min(height-1, y+1))
-      SW = (max(0, x-1),min(height-1, y+1))
-      W = (max(0, x-1), y)
-      NW = (max(0, x-1),max(0, y-1))
-      res = []
-      for d in [N, NE, E, SE, S, SW, W, NW]:
-        if d != c:
-          res.append(d)
-        else:
-          res.append(None)
-      return res
-
-        
 def main():
     """Main function"""
 